@@ -1425,7 +1425,7 @@ def write_gtf(self, fn, source='isotools', gzip=False, **filter_args):
         logger.info('writing %sgtf file to %s', "gzip compressed " if gzip else "", fn)
         for g, trids, _ in self.iter_transcripts(genewise=True, **filter_args):
             lines = g._to_gtf(trids=trids, source=source)
-            _ = f.write('\n'.join(('\t'.join(str(field) for field in line) for line in lines)) + '\n')
+            _ = f.write('\n'.join(lines) + '\n')
 
 
 def export_alternative_splicing(self, out_dir, out_format='mats', reference=False, min_total=100,
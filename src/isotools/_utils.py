@@ -7,7 +7,9 @@ from tqdm import tqdm
 import builtins
 import logging
 from scipy.stats import chi2_contingency, fisher_exact
+from scipy.ndimage import correlate1d
 import math
+from functools import lru_cache
 
 
 # from Kozak et al, NAR, 1987
@@ -251,11 +253,13 @@ def get_intersects(tr1, tr2):
     return sjintersect, intersect
 
 
+@lru_cache(maxsize=256)
 def _filter_function(expression):
     'converts a string e.g. "all(x[0]/x[1]>3) " into a function'
+    # cached, as the same filter expressions are compiled for each gene
     # extract argument names
     f = eval(f'lambda: {expression}')
-    args = [n for n in f.__code__.co_names if n not in dir(builtins)]
+    args = tuple(n for n in f.__code__.co_names if n not in dir(builtins))
 
     # potential issue: g.coverage gets detected as ["g", "coverage"], e.g. coverage is added. Probably not causing trubble
     return eval(f'lambda {",".join([arg+"=None" for arg in args]+["**kwargs"])}: bool({expression})\n', {}, {}), args
@@ -418,12 +422,9 @@ def get_quantiles(pos, percentile=[.5]):
 
 def smooth(x, window_len=31):
     """ smooth the data using a hanning window with requested size."""
-    # padding with mirrored
-    s = np.r_[x[window_len-1:0:-1], x, x[-2:-window_len-1:-1]]
-    # print(len(s))
+    # padding with mirrored (d c b | a b c d | c b a), done by correlate1d without building the padded copy
     w = np.hanning(window_len)
-    y = np.convolve(w/w.sum(), s, mode='valid')
-    return y[int(window_len/2-(window_len+1) % 2):-int(window_len/2)]
+    return correlate1d(np.asarray(x, dtype=float), w/w.sum(), mode='mirror')
 
 
 def prepare_contingency_table(eventA, eventB, coverage):
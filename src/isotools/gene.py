@@ -1,24 +1,21 @@
 from operator import itemgetter
+from functools import lru_cache
 from intervaltree import Interval
 from collections.abc import Iterable
-from scipy.stats import chi2_contingency
-from scipy.signal import find_peaks
-from Bio.Seq import reverse_complement, translate
-from Bio.Data.CodonTable import TranslationError
-from pysam import FastaFile
 import numpy as np
 import copy
-import itertools
-from cpmodule import fickett, FrameKmer  # this is from the CPAT module
 from .splice_graph import SegmentGraph
 from .short_read import Coverage
 from ._transcriptome_filter import SPLICE_CATEGORY
-from ._utils import pairwise, _filter_event, find_orfs, DEFAULT_KOZAK_PWM, kozak_score, smooth, get_quantiles, \
+from ._utils import pairwise, _filter_event, find_orfs, DEFAULT_KOZAK_PWM, kozak_score, smooth, \
     _filter_function, pairwise_event_test, prepare_contingency_table, cmp_dist
 
 import logging
 logger = logging.getLogger('isotools')
 
+# complement of (IUPAC) DNA letters, preserving the case of soft masked bases
+_RC = bytes.maketrans(b'ACGTMRWSYKVHDBNacgtmrwsykvhdbn', b'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+
 
 class Gene(Interval):
     'This class stores all gene information and transcripts. It is derived from intervaltree.Interval.'
@@ -30,6 +27,9 @@ class Gene(Interval):
 
     def __init__(self, begin, end, data, transcriptome):
         self._transcriptome = transcriptome
+        self._tpm_cache = None
+        self._exon_soa = {}  # (reference, trid) -> exons, exon arrays
+        self._sg_cache = {}  # reference -> exon content key, last segment graph
 
     def __str__(self):
         return 'Gene {} {}({}), {} reference transcripts, {} expressed transcripts'.format(
@@ -81,26 +81,32 @@ class Gene(Interval):
         '''Creates the gtf lines of the gene as strings.'''
         donotshow = {'transcripts', 'short_exons', 'segment_graph'}
         info = {'gene_id': self.id, 'gene_name': self.name}
-        lines = [None]
+        gene_attr = _fmt_attrs(info.items())  # prefix of the attributes of all transcript and exon lines
+        trids = list(trids)
+        ref_fsm = {refid for i in trids if self.transcripts[i]['annotation'][0] == 0 for refid in self.transcripts[i]['annotation'][1]['FSM']}
+        ref_trids = [i for i in range(self.n_ref_transcripts) if i not in ref_fsm] if ref_trids else []
+        # one line for the gene, and one for each transcript and exon
+        n_lines = 1 + sum(1 + len(self.transcripts[i]['exons']) for i in trids) + sum(1 + len(self.ref_transcripts[i]['exons']) for i in ref_trids)
+        lines = [None] * n_lines
+        k = 1  # index of the next line
         starts = []
         ends = []
-        ref_fsm = []
         for i in trids:
             tr = self.transcripts[i]
             info['transcript_id'] = f'{info["gene_id"]}_{i}'
             starts.append(tr['exons'][0][0] + 1)
             ends.append(tr['exons'][-1][1])
-            trinfo = info.copy()
+            exon_prefix = f'{gene_attr}; transcript_id "{info["transcript_id"]}"'  # shared by the transcript and all its exons
+            tr_attr = [exon_prefix]
             if 'downstream_A_content' in tr:
-                trinfo['downstream_A_content'] = f'{tr["downstream_A_content"]:0.3f}'
+                tr_attr.append(f'downstream_A_content "{tr["downstream_A_content"]:0.3f}"')
             if tr['annotation'][0] == 0:  # FSM
                 refinfo = {}
                 for refid in tr['annotation'][1]['FSM']:
-                    ref_fsm.append(refid)
-                    for k in self.ref_transcripts[refid]:
-                        if k == 'exons':
+                    for key in self.ref_transcripts[refid]:
+                        if key == 'exons':
                             continue
-                        elif k == 'CDS':
+                        elif key == 'CDS':
                             if self.strand == '+':
                                 cds_start, cds_end = self.ref_transcripts[refid]['CDS']
                             else:
@@ -108,55 +114,54 @@ class Gene(Interval):
                             refinfo.setdefault('CDS_start', []).append(str(cds_start))
                             refinfo.setdefault('CDS_end', []).append(str(cds_end))
                         else:
-                            refinfo.setdefault(k, []).append(str(self.ref_transcripts[refid][k]))
-                for k, vlist in refinfo.items():
-                    trinfo[f'ref_{k}'] = ','.join(vlist)
+                            refinfo.setdefault(key, []).append(str(self.ref_transcripts[refid][key]))
+                tr_attr.extend(f'ref_{key} "{",".join(vlist)}"' for key, vlist in refinfo.items())
             else:
-                trinfo['novelty'] = ','.join(k for k in tr['annotation'][1])
-            lines.append((self.chrom, source, 'transcript', tr['exons'][0][0] + 1, tr['exons'][-1][1], '.',
-                         self.strand, '.', '; '.join(f'{k} "{v}"' for k, v in trinfo.items())))
+                tr_attr.append(f'novelty "{",".join(tr["annotation"][1])}"')
+            lines[k] = f'{self.chrom}\t{source}\ttranscript\t{tr["exons"][0][0] + 1}\t{tr["exons"][-1][1]}\t.\t{self.strand}\t.\t{"; ".join(tr_attr)}'
+            k += 1
             noncanonical = tr.get('noncanonical_splicing', [])
             for enr, pos in enumerate(tr['exons']):
-                exon_info = info.copy()
-                exon_info['exon_id'] = f'{info["gene_id"]}_{i}_{enr}'
+                exon_attr = [exon_prefix, f'exon_id "{info["gene_id"]}_{i}_{enr}"']
                 if enr in noncanonical:
-                    exon_info['noncanonical_donor'] = noncanonical[enr][:2]
+                    exon_attr.append(f'noncanonical_donor "{noncanonical[enr][:2]}"')
                 if enr+1 in noncanonical:
-                    exon_info['noncanonical_acceptor'] = noncanonical[enr+1][2:]
-                lines.append((self.chrom, source, 'exon', pos[0] + 1, pos[1], '.', self.strand, '.', '; '.join(f'{k} "{v}"' for k, v in exon_info.items())))
-        if ref_trids:
-            # add reference transcripts not covered by FSM
-            for i, tr in enumerate(self.ref_transcripts):
-                if i in ref_fsm:
+                    exon_attr.append(f'noncanonical_acceptor "{noncanonical[enr+1][2:]}"')
+                lines[k] = f'{self.chrom}\t{source}\texon\t{pos[0] + 1}\t{pos[1]}\t.\t{self.strand}\t.\t{"; ".join(exon_attr)}'
+                k += 1
+        # add reference transcripts not covered by FSM
+        for i in ref_trids:
+            tr = self.ref_transcripts[i]
+            starts.append(tr['exons'][0][0] + 1)
+            ends.append(tr['exons'][-1][1])
+            info['transcript_id'] = f'{info["gene_id"]}_ref{i}'
+            refinfo = info.copy()
+            for key in tr:
+                if key == 'exons':
                     continue
-                starts.append(tr['exons'][0][0] + 1)
-                ends.append(tr['exons'][-1][1])
-                info['transcript_id'] = f'{info["gene_id"]}_ref{i}'
-                refinfo = info.copy()
-                for k in tr:
-                    if k == 'exons':
-                        continue
-                    elif k == 'CDS':
-                        if self.strand == '+':
-                            cds_start, cds_end = tr['CDS']
-                        else:
-                            cds_end, cds_start = tr['CDS']
-                        refinfo['CDS_start'] = str(cds_start)
-                        refinfo['CDS_end'] = str(cds_end)
+                elif key == 'CDS':
+                    if self.strand == '+':
+                        cds_start, cds_end = tr['CDS']
                     else:
-                        refinfo.setdefault(k, []).append(str(tr[k]))
-                    lines.append((self.chrom, ref_source, 'transcript', tr['exons'][0][0] + 1, tr['exons'][-1][1], '.',
-                                  self.strand, '.', '; '.join(f'{k} "{v}"' for k, v in refinfo.items())))
-                    for enr, pos in enumerate(tr['exons']):
-                        exon_info = info.copy()
-                        exon_id = f'{info["gene_id"]}_ref{i}_{enr}'
-                        lines.append((self.chrom, ref_source, 'exon', pos[0] + 1, pos[1], '.', self.strand, '.', f'exon_id "{exon_id}"'))
-
-        if len(lines) > 1:
+                        cds_end, cds_start = tr['CDS']
+                    refinfo['CDS_start'] = str(cds_start)
+                    refinfo['CDS_end'] = str(cds_end)
+                else:
+                    refinfo[key] = str(tr[key])
+            lines[k] = f'{self.chrom}\t{ref_source}\ttranscript\t{tr["exons"][0][0] + 1}\t{tr["exons"][-1][1]}\t.\t{self.strand}\t.\t' + \
+                _fmt_attrs(refinfo.items())
+            k += 1
+            exon_prefix = f'{gene_attr}; transcript_id "{refinfo["transcript_id"]}"'
+            for enr, pos in enumerate(tr['exons']):
+                lines[k] = f'{self.chrom}\t{ref_source}\texon\t{pos[0] + 1}\t{pos[1]}\t.\t{self.strand}\t.\t' + \
+                    f'{exon_prefix}; exon_id "{info["gene_id"]}_ref{i}_{enr}"'
+                k += 1
+
+        if n_lines > 1:
             # add gene line
             if 'reference' in self.data:
-                info.update({k: v for k, v in self.data['reference'].items() if k not in donotshow})  # add reference gene specific fields
-            lines[0] = (self.chrom, source, 'gene', min(starts), max(ends), '.', self.strand, '.', '; '.join(f'{k} "{v}"' for k, v in info.items()))
+                info.update({key: v for key, v in self.data['reference'].items() if key not in donotshow})  # add reference gene specific fields
+            lines[0] = f'{self.chrom}\t{source}\tgene\t{min(starts)}\t{max(ends)}\t.\t{self.strand}\t.\t{_fmt_attrs(info.items())}'
             return lines
         return []
 
@@ -169,19 +174,18 @@ class Gene(Interval):
         True noncanonical splicing is rare, thus it might indicate technical artifacts (template switching, misalignment, ...)
 
         :param genome_fh: A file handle of the genome fastA file.'''
-        ss_seq = {}
-        for tr in self.transcripts:
-            pos = [(tr['exons'][i][1], tr['exons'][i + 1][0] - 2) for i in range(len(tr['exons']) - 1)]
-            new_ss_seq = {site: genome_fh.fetch(self.chrom, site, site + 2).upper() for intron in pos for site in intron if site not in ss_seq}
-            if new_ss_seq:
-                ss_seq.update(new_ss_seq)
-
-            if self.strand == '+':
-                sj_seq = [ss_seq[d] + ss_seq[a] for d, a in pos]
-            else:
-                sj_seq = [reverse_complement(ss_seq[d] + ss_seq[a]) for d, a in pos]
-
-            nc = [(i, seq) for i, seq in enumerate(sj_seq) if seq != 'GTAG']
+        introns = [[(tr['exons'][i][1], tr['exons'][i + 1][0] - 2) for i in range(len(tr['exons']) - 1)] for tr in self.transcripts]
+        sites = {intron for pos in introns for intron in pos}  # most introns are shared by several transcripts
+        if not sites:
+            return
+        seq_start = min(d for d, _ in sites)
+        seq_end = max(a for _, a in sites) + 2
+        gene_seq = genome_fh.fetch(self.chrom, seq_start, seq_end).upper()  # fetch the sequence only once per gene
+        ss_seq = {(d, a): gene_seq[d - seq_start:d - seq_start + 2] + gene_seq[a - seq_start:a - seq_start + 2] for d, a in sites}
+        if self.strand == '-':
+            ss_seq = {intron: _revcomp(seq) for intron, seq in ss_seq.items()}
+        for tr, pos in zip(self.transcripts, introns):
+            nc = [(i, ss_seq[intron]) for i, intron in enumerate(pos) if ss_seq[intron] != 'GTAG']
             if nc:
                 tr['noncanonical_splicing'] = nc
 
@@ -197,24 +201,15 @@ class Gene(Interval):
         :param max_mm: The maximum length of direct repeats that can be found.
         :param wobble: The maximum length of direct repeats that can be found.'''
 
-        intron_seq = {}
+        introns = {intron for tr in self.transcripts for intron in ((e1[1], e2[0]) for e1, e2 in pairwise(tr['exons']))}
         score = {}
-
-        for tr in self.transcripts:
-            for intron in ((tr['exons'][i][1], tr['exons'][i + 1][0]) for i in range(len(tr['exons']) - 1)):
-                for pos in intron:
-                    try:
-                        intron_seq.setdefault(pos, genome_fh.fetch(self.chrom, pos - delta, pos + delta))
-                    except (ValueError, IndexError):  # N padding at start/end of the chromosomes
-                        chr_len = genome_fh.get_reference_length(self.chrom)
-                        seq = genome_fh.fetch(self.chrom, max(0, pos - delta), min(chr_len, pos + delta))
-                        if pos - delta < 0:
-                            seq = ''.join(['N'] * (pos - delta)) + seq
-                        if pos + delta > chr_len:
-                            seq += ''.join(['N'] * (pos + delta - chr_len))
-                        intron_seq.setdefault(pos, seq)
-                if intron not in score:
-                    score[intron] = repeat_len(intron_seq[intron[0]], intron_seq[intron[1]], wobble=wobble, max_mm=max_mm)
+        if introns:
+            seq_start = min(intron[0] for intron in introns) - delta
+            seq_end = max(intron[1] for intron in introns) + delta
+            gene_seq = _fetch_padded(genome_fh, self.chrom, seq_start, seq_end)  # fetch the sequence only once per gene
+            for intron in introns:
+                donor, acceptor = (gene_seq[pos - delta - seq_start:pos + delta - seq_start] for pos in intron)
+                score[intron] = repeat_len(donor, acceptor, wobble=wobble, max_mm=max_mm)
 
         for tr in self.transcripts:
             tr['direct_repeat_len'] = [min(score[(e1[1], e2[0])], delta) for e1, e2 in pairwise(tr['exons'])]
@@ -228,18 +223,23 @@ class Gene(Interval):
         :param geneome_fh: A file handle for the indexed genome fastA file.
         :param length: The length of the downstream region to be considered.
         '''
+        trL = [t for tL in (self.transcripts, self.ref_transcripts) for t in tL]
+        if not trL:
+            return
+        if self.strand == '+':
+            positions = [tr['exons'][-1][1] for tr in trL]
+            base = ord('A')
+        else:
+            positions = [tr['exons'][0][0] - length for tr in trL]
+            base = ord('T')
+        seq_start = max(0, min(positions))
+        # fetch the sequence once, and clear bit 5 of the ascii codes to convert to upper case
+        gene_seq = np.frombuffer(genome_fh.fetch(self.chrom, seq_start, max(positions) + length).encode('ascii'), dtype=np.uint8) & 0xDF
         a_content = {}
-        for tr in (t for tL in (self.transcripts, self.ref_transcripts) for t in tL):
-            if self.strand == '+':
-                pos = tr['exons'][-1][1]
-            else:
-                pos = tr['exons'][0][0] - length
+        for tr, pos in zip(trL, positions):
             if pos not in a_content:
-                seq = genome_fh.fetch(self.chrom, max(0, pos), pos + length)
-                if self.strand == '+':
-                    a_content[pos] = seq.upper().count('A') / length
-                else:
-                    a_content[pos] = seq.upper().count('T') / length
+                seq = gene_seq[max(0, pos) - seq_start:pos + length - seq_start]
+                a_content[pos] = int(np.count_nonzero(seq == base)) / length
             tr['downstream_A_content'] = a_content[pos]
 
     def get_sequence(self, genome_fh, trids=None, reference=False, protein=False):
@@ -256,6 +256,7 @@ class Gene(Interval):
         trL = [(i, tr) for i, tr in enumerate(self.ref_transcripts if reference else self.transcripts) if trids is None or i in trids]
         if not trL:
             return {}
+        from pysam import FastaFile
         pos = (min(tr['exons'][0][0] for _, tr in trL), max(tr['exons'][-1][1] for _, tr in trL))
         try:  # assume its a FastaFile file handle
             seq = genome_fh.fetch(self.chrom, *pos)
@@ -263,17 +264,24 @@ class Gene(Interval):
             genome_fn = genome_fh
             with FastaFile(genome_fn) as genome_fh:
                 seq = genome_fh.fetch(self.chrom, *pos)
+        reverse_strand = self.strand == '-'
+        seq = seq.encode('ascii')
+        if reverse_strand:  # reverse complement the region once, and assemble the exons in reverse order
+            seq = seq.translate(_RC)[::-1]
+        seq = memoryview(seq)
+        buffer = memoryview(bytearray(max(self._get_exon_arrays(i, reference)[2][-1] for i, _ in trL)))  # reused for all transcripts
         tr_seqs = {}
         for i, tr in trL:
-            trseq = ''
-            for e in tr['exons']:
-                trseq += seq[e[0]-pos[0]:e[1]-pos[0]]
-            tr_seqs[i] = trseq
-
-        if self.strand == '-':
-            tr_seqs = {i: reverse_complement(ts) for i, ts in tr_seqs.items()}
+            tr_len = 0
+            for e in reversed(tr['exons']) if reverse_strand else tr['exons']:
+                offset = pos[1]-e[1] if reverse_strand else e[0]-pos[0]
+                buffer[tr_len:tr_len+e[1]-e[0]] = seq[offset:offset+e[1]-e[0]]
+                tr_len += e[1]-e[0]
+            tr_seqs[i] = str(buffer[:tr_len], 'ascii')
         if not protein:
             return tr_seqs
+        from Bio.Seq import translate
+        from Bio.Data.CodonTable import TranslationError
         prot_seqs = {}
         for i, tr in trL:
             orf = tr.get("CDS", tr.get("ORF"))
@@ -301,20 +309,18 @@ class Gene(Interval):
                 else:
                     utr[i] = [e for e in tr['exons'] if e[1] > tr['CDS'][1]]
 
+        # UTR splice sites must match the splice sites of the transcript (in the direction of transcription)
+        utr_junctions = {i: _junction_arrays(*_exon_arrays(reg)[:2], reverse_strand) for i, reg in utr.items()}
         for trid in trids:
             tr = self.transcripts[trid]
             match_cds[trid] = {}
-            for i, reg in utr.items():
-                if not any(s <= anno_cds[i][reverse_strand] <= e for s, e in tr['exons']):  # no overlap of CDS init with exons
+            starts, ends, _ = self._get_exon_arrays(trid)
+            tr_donors, tr_acceptors = _junction_arrays(starts, ends, reverse_strand)
+            for i, (reg_donors, reg_acceptors) in utr_junctions.items():
+                if not np.any((starts <= anno_cds[i][reverse_strand]) & (anno_cds[i][reverse_strand] <= ends)):  # no overlap of CDS init with exons
                     continue
-                if not reverse_strand:
-                    to_check = zip(pairwise(reg), pairwise(tr['exons']))
-                else:
-                    to_check = zip(pairwise((e, s) for s, e in reversed(reg)), pairwise((e, s) for s, e in reversed(tr['exons'])))
-                for ((e1reg, e2reg), (e1, e2)) in to_check:
-                    if (e1reg[1] != e1[1] or e2reg[0] != e2[0]):
-                        break
-                else:
+                n = min(len(reg_donors), len(tr_donors))
+                if np.array_equal(reg_donors[:n], tr_donors[:n]) and np.array_equal(reg_acceptors[:n], tr_acceptors[:n]):
                     pos = self.find_transcript_positions(trid, anno_cds[i], reference=False)[reverse_strand]
                     match_cds[trid].setdefault(pos, []).append(i)
         return match_cds
@@ -351,6 +357,7 @@ class Gene(Interval):
         assert min_kozak is None or kozak_matrix is not None, 'Kozak matrix missing for min_kozak'
         if not tr_dict:
             return
+        from cpmodule import fickett, FrameKmer  # this is from the CPAT module
         if prefer_annotated_init:
             if reference:
                 ref_cds = {}
@@ -363,6 +370,7 @@ class Gene(Interval):
             else:
                 ref_cds = self._get_ref_cds_pos(trids=tr_dict.keys())
 
+        hexamer, fickett_score = {}, {}  # isoforms often share the same CDS sequence
         for trid, tr_seq in self.get_sequence(genome_fh, trids=tr_dict.keys(), reference=reference).items():
             orfs = find_orfs(
                     tr_seq, start_codons, stop_codons, ref_cds[trid] if prefer_annotated_init else [])
@@ -388,21 +396,19 @@ class Gene(Interval):
                         continue
                 else:
                     start, stop, frame, seq_start, seq_end, uORFs, ref_trids = valid_orfs[0]
-
-                start, stop, frame, seq_start, seq_end, uORFs, ref_trids = valid_orfs[0]
             # if stop is None or stop - start < minlen:
             #    continue
 
             tr = tr_dict[trid]
-            tr_start = tr['exons'][0][0]
-            cum_exon_len = np.cumsum([end-start for start, end in tr['exons']])  # cumulative exon length
-            cum_intron_len = np.cumsum([0]+[end-start for (_, start), (end, _) in pairwise(tr['exons'])])  # cumulative intron length
+            exon_starts, _, cum_len = self._get_exon_arrays(trid, reference)
+            tr_start = exon_starts[0]
+            cum_exon_len = cum_len[1:]  # cumulative exon length
+            cum_intron_len = exon_starts-tr_start-cum_len[:-1]  # cumulative intron length
             if self.strand == '-':
                 fwd_start, fwd_stop = cum_exon_len[-1]-stop, cum_exon_len[-1]-start
             else:
                 fwd_start, fwd_stop = start, stop  # start/stop position wrt genomic fwd strand
-            start_exon = next(i for i in range(len(cum_exon_len)) if cum_exon_len[i] >= fwd_start)
-            stop_exon = next(i for i in range(start_exon, len(cum_exon_len)) if cum_exon_len[i] >= fwd_stop)
+            start_exon, stop_exon = np.searchsorted(cum_exon_len, [fwd_start, fwd_stop])
             genome_pos = (tr_start+fwd_start+cum_intron_len[start_exon],
                           tr_start+fwd_stop+cum_intron_len[stop_exon])
             dist_pas = 0  # distance of termination codon to last upstream splice site
@@ -418,10 +424,15 @@ class Gene(Interval):
                 else:
                     orf_dict['kozak'] = kozak
 
+            cds = tr_seq[start:stop]
             if coding_hexamers is not None and noncoding_hexamers is not None:
-                orf_dict['hexamer'] = FrameKmer.kmer_ratio(tr_seq[start:stop], 6, 3, coding_hexamers, noncoding_hexamers)
+                if cds not in hexamer:
+                    hexamer[cds] = FrameKmer.kmer_ratio(cds, 6, 3, coding_hexamers, noncoding_hexamers)
+                orf_dict['hexamer'] = hexamer[cds]
             if get_fickett:
-                orf_dict['fickett'] = fickett.fickett_value(tr_seq[start:stop])
+                if cds not in fickett_score:
+                    fickett_score[cds] = fickett.fickett_value(cds)
+                orf_dict['fickett'] = fickett_score[cds]
             tr['ORF'] = (*genome_pos, orf_dict)
 
     def add_fragments(self):
@@ -440,12 +451,11 @@ class Gene(Interval):
         :param trid: The transcript index for which the coding length is requested. '''
 
         try:
-            exons = self.transcripts[trid]['exons']
             cds = self.transcripts[trid]['CDS']
         except KeyError:
             return None
         else:
-            coding_len = _coding_len(exons, cds)
+            coding_len = _coding_len(self._get_exon_arrays(trid), cds)
         if self.strand == '-':
             coding_len.reverse()
         return coding_len
@@ -457,7 +467,7 @@ class Gene(Interval):
     def _get_info(self, trid, key, sample_i, group_i, **kwargs):
         # returns tuples (as some keys return multiple values)
         if key == 'length':
-            return sum((e - b for b, e in self.transcripts[trid]['exons'])),
+            return int(self._get_exon_arrays(trid)[2][-1]),
         elif key == 'n_exons':
             return len(self.transcripts[trid]['exons']),
         elif key == 'exon_starts':
@@ -474,7 +484,7 @@ class Gene(Interval):
         elif key == 'coverage':
             return self.coverage[sample_i, trid]
         elif key == 'tpm':
-            return self.tpm(kwargs.get('pseudocount', 1))[sample_i, trid]
+            return self._cached_tpm(kwargs.get('pseudocount', 1))[sample_i, trid]
         elif key == 'group_coverage_sum':
             return tuple(self.coverage[si, trid].sum() for si in group_i)
         elif key == 'group_tpm_mean':
@@ -489,29 +499,47 @@ class Gene(Interval):
 
     def _set_coverage(self, force=False):
         samples = self._transcriptome.samples
-        cov = np.zeros((len(samples), self.n_transcripts), dtype=int)
+        cov = np.zeros((len(samples), self.n_transcripts), dtype=np.int64)
+        n_known = None
         if not force:  # keep the segment graph if no new transcripts
             known = self.data.get('coverage', None)
             if known is not None and known.shape[1] == self.n_transcripts:
                 if known.shape == cov.shape:
                     return
                 cov[:known.shape[0], :] = known
-                for i in range(known.shape[0], len(samples)):
-                    for j, tr in enumerate(self.transcripts):
-                        cov[i, j] = tr['coverage'].get(samples[i], 0)
-                self.data['coverage'] = cov
-                return
-        for i, sa in enumerate(samples):
-            for j, tr in enumerate(self.transcripts):
-                cov[i, j] = tr['coverage'].get(sa, 0)
-        self.data['coverage'] = cov
-        self.data['segment_graph'] = None
+                n_known = known.shape[0]
+        sample_idx = {sa: i for i, sa in enumerate(samples) if n_known is None or i >= n_known}
+        for j, tr in enumerate(self.transcripts):
+            tr_samples = [sa for sa in tr['coverage'] if sa in sample_idx]
+            if tr_samples:
+                cov[[sample_idx[sa] for sa in tr_samples], j] = [tr['coverage'][sa] for sa in tr_samples]
+        # stored as int32, which halves the memory traffic of the frequent coverage reductions (numpy accumulates sums as int64).
+        # The range is checked once here, as narrowing casts wrap silently.
+        if cov.max(initial=0) > np.iinfo(np.int32).max:
+            raise OverflowError(f'coverage of gene {self.id} exceeds the int32 range')
+        self.data['coverage'] = cov.astype(np.int32)
+        self._tpm_cache = None
+        if n_known is None:
+            self.data['segment_graph'] = None
 
     def tpm(self, pseudocount=1):
         '''Returns the transcripts per million (TPM).
 
         TPM is returned as a numpy array, with samples in columns and transcript isoforms in the rows.'''
-        return (self.coverage+pseudocount)/self._transcriptome.sample_table['nonchimeric_reads'].values.reshape(-1, 1)*1e6
+        return self._cached_tpm(pseudocount).copy()
+
+    def _cached_tpm(self, pseudocount=1):
+        '''Returns the TPM array cached for the filter queries. It is shared between calls and thus read only.'''
+        cov = self.coverage
+        sample_table = self._transcriptome.sample_table  # gets replaced, not modified, when samples are added or removed
+        if self._tpm_cache is not None:
+            cached_pseudocount, cached_cov, cached_sample_table, tpm = self._tpm_cache
+            if cached_pseudocount == pseudocount and cached_cov is cov and cached_sample_table is sample_table:
+                return tpm
+        tpm = (cov+pseudocount)/sample_table['nonchimeric_reads'].values.reshape(-1, 1)*1e6
+        tpm.flags.writeable = False  # shared between calls
+        self._tpm_cache = (pseudocount, cov, sample_table, tpm)
+        return tpm
 
     def find_transcript_positions(self, trid, pos, reference=False):
         '''Converts genomic positions to positions within the transcript.
@@ -519,25 +547,28 @@ class Gene(Interval):
         :param trid: The transcript id
         :param pos: List of sorted genomic positions, for which the transcript positions are computed.'''
 
-        tr_pos = []
-        exons = self.ref_transcripts[trid]['exons'] if reference else self.transcripts[trid]['exons']
-        e_idx = 0
-        offset = 0
-        for p in sorted(pos):
-            try:
-                while p > exons[e_idx][1]:
-                    offset += (exons[e_idx][1]-exons[e_idx][0])
-                    e_idx += 1
-
-            except IndexError:
-                for _ in range(len(pos)-len(tr_pos)):
-                    tr_pos.append(None)
-                break
-            tr_pos.append(offset+p-exons[e_idx][0] if p >= exons[e_idx][0] else None)
+        starts, ends, cum_len = self._get_exon_arrays(trid, reference)
+        pos = np.sort(np.asarray(pos, dtype=np.int64))
+        e_idx = np.searchsorted(ends, pos)  # first exon ending at or after pos
+        valid = e_idx < len(ends)  # positions downstream of the last exon are not in the transcript
+        e_idx[~valid] = len(ends)-1
+        valid &= pos >= starts[e_idx]  # intronic positions
+        tr_pos = cum_len[e_idx]+pos-starts[e_idx]
         if self.strand == '-':
-            trlen = sum(end-start for start, end in exons)
-            tr_pos = [None if p is None else trlen-p for p in tr_pos]
-        return tr_pos
+            tr_pos = cum_len[-1]-tr_pos
+        return [p if v else None for p, v in zip(tr_pos.tolist(), valid.tolist())]
+
+    def _get_exon_arrays(self, trid, reference=False):
+        '''Returns exon starts, exon ends and cumulative exon length of a transcript as numpy arrays (see _exon_arrays).
+
+        The arrays are cached. They are recomputed if the exon list of the transcript got replaced, changed in length,
+        or if the transcript start or end got modified (e.g. by _unify_ends). The arrays must not be modified.'''
+        exons = (self.ref_transcripts if reference else self.transcripts)[trid]['exons']
+        check = (len(exons), exons[0][0], exons[-1][1])
+        cached = self._exon_soa.get((reference, trid))
+        if cached is None or cached[0] is not exons or cached[1] != check:
+            cached = self._exon_soa[(reference, trid)] = (exons, check, _exon_arrays(exons))
+        return cached[2]
 
     @property
     def coverage(self):
@@ -640,7 +671,7 @@ class Gene(Interval):
         assert self.is_annotated, "reference segment graph requested on novel gene"
         if 'segment_graph' not in self.data['reference'] or self.data['reference']['segment_graph'] is None:
             transcript_exons = [tr['exons'] for tr in self.ref_transcripts]
-            self.data['reference']['segment_graph'] = SegmentGraph(transcript_exons, self.strand)
+            self.data['reference']['segment_graph'] = self._build_segment_graph(transcript_exons, True)
         return self.data['reference']['segment_graph']
 
     @property
@@ -649,12 +680,20 @@ class Gene(Interval):
         if 'segment_graph' not in self.data or self.data['segment_graph'] is None:
             transcript_exons = [transcript['exons'] for transcript in self.transcripts]
             try:
-                self.data['segment_graph'] = SegmentGraph(transcript_exons, self.strand)
+                self.data['segment_graph'] = self._build_segment_graph(transcript_exons, False)
             except Exception:
                 logger.error('Error initializing Segment Graph on %s with exons %s', self.strand, transcript_exons)
                 raise
         return self.data['segment_graph']
 
+    def _build_segment_graph(self, transcript_exons, reference):
+        '''Returns the segment graph for the exons. Reuses the last graph if it was invalidated but the exons did not change.'''
+        key = _exons_key(transcript_exons)
+        cached = self._sg_cache.get(reference)
+        if cached is None or cached[0] != key:
+            cached = self._sg_cache[reference] = (key, SegmentGraph(transcript_exons, self.strand))
+        return cached[1]
+
     def __copy__(self):
         return Gene(self.start, self.end, self.data, self._transcriptome)
 
@@ -677,14 +716,17 @@ class Gene(Interval):
             assert all(f in tr_filter for f in used_tags), msg.format(
                 ', '.join(f for f in used_tags if f not in tr_filter), ', '.join(tr_filter))
             tr_filter_fun = {tag: _filter_function(tr_filter[tag])[0] for tag in used_tags if tag in tr_filter}
+        keep = np.ones(len(self.transcripts), dtype=bool)
+        if min_coverage or max_coverage:
+            cov_tot = self.coverage.sum(0)  # total coverage per transcript
+            if min_coverage:
+                keep &= cov_tot >= min_coverage
+            if max_coverage:
+                keep &= cov_tot <= max_coverage
         trids = []
-        for i, tr in enumerate(self.transcripts):
-            if min_coverage and self.coverage[:, i].sum() < min_coverage:
-                continue
-            if max_coverage and self.coverage[:, i].sum() > max_coverage:
-                continue
+        for i in np.flatnonzero(keep).tolist():
             if query is None or query_fun(
-                    **{tag: f(g=self, trid=i, **tr) for tag, f in tr_filter_fun.items()}):
+                    **{tag: f(g=self, trid=i, **self.transcripts[i]) for tag, f in tr_filter_fun.items()}):
                 trids.append(i)
         return trids
 
@@ -705,6 +747,7 @@ class Gene(Interval):
                 trids.append(i)
         return trids
 
+    @staticmethod
     def _find_splice_sites(exons, transcripts):
         '''Checks whether the splice sites of a new transcript are present in the set of transcripts.
         avoids the computation of segment graph, which provides the same functionality.
@@ -713,19 +756,17 @@ class Gene(Interval):
         :type exons: list
         :return: boolean array indicating whether the splice site is contained or not'''
 
-        intron_iter = [pairwise(tr['exons']) for tr in transcripts]
-        current = [next(tr) for tr in intron_iter]
-        contained = np.zeros(len(exons)-1)
-        for j, (e1, e2) in enumerate(pairwise(exons)):
-            for i, tr in enumerate(intron_iter):
-                while current[i][0][1] < e1[1]:
-                    try:
-                        current[i] = next(tr)
-                    except StopIteration:
-                        continue
-                if e1[1] == current[i][0][1] and e2[0] == current[i][1][0]:
-                    contained[j] = True
-        return current
+        q_donors = np.fromiter((e[1] for e in exons[:-1]), dtype=np.int64, count=max(len(exons) - 1, 0))
+        q_acc = np.fromiter((e[0] for e in exons[1:]), dtype=np.int64, count=max(len(exons) - 1, 0))
+        contained = np.zeros(len(q_donors), dtype=bool)
+        for tr in transcripts:
+            if len(tr['exons']) < 2:
+                continue
+            donors = np.fromiter((e[1] for e in tr['exons'][:-1]), dtype=np.int64, count=len(tr['exons']) - 1)
+            acc = np.fromiter((e[0] for e in tr['exons'][1:]), dtype=np.int64, count=len(tr['exons']) - 1)
+            idx = np.minimum(np.searchsorted(donors, q_donors), len(donors) - 1)  # donors of a transcript are sorted and unique
+            contained |= (donors[idx] == q_donors) & (acc[idx] == q_acc)
+        return contained
 
     def coordination_test(self, samples=None, test="chi2", min_dist=1, min_total=100, min_alt_fraction=.1,
                           events=None, event_type=("ES", "5AS", "3AS", "IR", "ME")):
@@ -762,14 +803,16 @@ class Gene(Interval):
         if samples is None:
             cov = self.coverage.sum(axis=0)
         else:
+            coverage = self.coverage
             try:
                 # Fast mode when testing several genes
-                cov = self.coverage[samples].sum(0)
-            except IndexError:
+                sample_ind = _group_indicator((tuple(samples),), coverage.shape[0])
+            except (IndexError, TypeError, ValueError):
                 # Fall back to looking up the sample indices
                 from isotools._transcriptome_stats import _check_groups
                 _, _, groups = _check_groups(self._transcriptome, [samples], 1)
-                cov = self.coverage[groups[0]].sum(0)
+                sample_ind = _group_indicator((tuple(groups[0]),), coverage.shape[0])
+            cov = coverage.T @ sample_ind[:, 0]
 
         sg = self.segment_graph
 
@@ -784,25 +827,53 @@ class Gene(Interval):
         else:
             events.sort(key=itemgetter(3, 2), reverse=True)  # reverse sort by end node
         test_res = []
-
-        for i, j in itertools.combinations(range(len(events)), 2):
-            if sg.events_dist(events[i], events[j]) < min_dist:
-                continue
-            if (events[i][4], events[j][4]) == ("TSS", "TSS") or (events[i][4], events[j][4]) == ("PAS", "PAS"):
-                continue
-
+        # per event, the membership of the transcripts in the primary and alternative state
+        n_events = len(events)
+        state_mask = np.zeros((n_events, 2, len(cov)), dtype=bool)
+        for i, e in enumerate(events):
+            state_mask[i, 0, e[0]] = True
+            state_mask[i, 1, e[1]] = True
+        event_types = tuple(e[4] for e in events)
+        # pre-filter the event pairs by distance (as in sg.events_dist) and type, in the order of itertools.combinations
+        ev_start = np.array([sg[e[2]].start for e in events], dtype=np.int64)
+        ev_end = np.array([sg[e[3]].end for e in events], dtype=np.int64)
+        ev_types = np.array(event_types, dtype=object)
+        same_type_skip = np.isin(ev_types, ("TSS", "PAS"))
+        idx_i, idx_j = [], []
+        for i in range(n_events - 1):  # one row of the pair matrix at a time, to keep the memory linear
+            j = np.arange(i + 1, n_events)
+            valid = np.maximum(ev_start[i], ev_start[j]) - np.minimum(ev_end[i], ev_end[j]) >= min_dist
+            if same_type_skip[i]:
+                valid &= ev_types[j] != ev_types[i]
+            idx_i.append(np.full(np.count_nonzero(valid), i))
+            idx_j.append(j[valid])
+        idx_i = np.concatenate(idx_i) if idx_i else np.zeros(0, dtype=int)
+        idx_j = np.concatenate(idx_j) if idx_j else np.zeros(0, dtype=int)
+        # coverage tables of the remaining event pairs: con_tabs[k, n, m] is the coverage of the transcripts
+        # in state m of event idx_i[k] and state n of event idx_j[k]. Computed in blocks of pairs, to bound the memory.
+        cov_f = cov.astype(np.float64)
+        con_tabs = np.empty((len(idx_i), 2, 2))
+        block = max(1, (1 << 20) // max(2 * len(cov), 1))
+        for k in range(0, len(idx_i), block):
+            blk = slice(k, k + block)
+            con_tabs[blk] = np.einsum('knt,kmt->knm', state_mask[idx_j[blk]] * cov_f, state_mask[idx_i[blk]])
+        total = con_tabs.sum((1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            alt_fraction = np.minimum(con_tabs.sum(2).min(1), con_tabs.sum(1).min(1)) / total
+        # check that the joint occurrence of the two events passes the thresholds
+        valid = (total >= min_total) & ~(alt_fraction < min_alt_fraction)
+        idx_i, idx_j = idx_i[valid].tolist(), idx_j[valid].tolist()
+        # coordinates of the events in the tested pairs, computed once per event
+        coordinates = {k: sg._get_event_coordinate(events[k]) for k in set(idx_i).union(idx_j)}
+
+        for i, j in zip(idx_i, idx_j):
             con_tab, tr_ID_tab = prepare_contingency_table(events[i], events[j], cov)
-
-            if con_tab.sum(None) < min_total:  # check that the joint occurrence of the two events passes the threshold
-                continue
-            if min(con_tab.sum(1).min(), con_tab.sum(0).min())/con_tab.sum(None) < min_alt_fraction:
-                continue
             test_result = pairwise_event_test(con_tab, test=test)  # append to test result
 
-            coordinate1 = sg._get_event_coordinate(events[i])
-            coordinate2 = sg._get_event_coordinate(events[j])
+            coordinate1 = coordinates[i]
+            coordinate2 = coordinates[j]
 
-            attr = (self.id, self.name, self.strand, events[i][4], events[j][4]) + \
+            attr = (self.id, self.name, self.strand, event_types[i], event_types[j]) + \
                 coordinate1 + coordinate2 + test_result + \
                 tuple(con_tab.flatten()) + tuple(tr_ID_tab.flatten())
 
@@ -826,38 +897,51 @@ class Gene(Interval):
         :param min_cov: Minimal number of reads per group for the gene.
         :param n_isoforms: Number of isoforms to consider in the test for the gene. All additional least expressed isoforms get summarized.'''
         # select the samples and sum the group counts
+        coverage = self.coverage
         try:
             # Fast mode when testing several genes
-            cov = np.array([self.coverage[grp].sum(0) for grp in groups]).T
-        except IndexError:
+            group_ind = _group_indicator(tuple(map(tuple, groups)), coverage.shape[0])
+        except (IndexError, TypeError, ValueError):
             # Fall back to looking up the sample indices
             from isotools._transcriptome_stats import _check_groups
             _, _, groups = _check_groups(self._transcriptome, groups)
-            cov = np.array([self.coverage[grp].sum(0) for grp in groups]).T
+            group_ind = _group_indicator(tuple(map(tuple, groups)), coverage.shape[0])
+        cov = coverage.T @ group_ind  # transcripts x groups
 
-        if np.any(cov.sum(0) < min_cov):
+        group_total = cov.sum(0)
+        if np.any(group_total < min_cov):
             return np.nan, np.nan, []
         # if there are more than 'numIsoforms' isoforms of the gene, all additional least expressed get summarized.
         if cov.shape[0] > n_isoforms:
-            idx = np.argpartition(-cov.sum(1), n_isoforms)  # take the n_isoforms most expressed isoforms (random order)
-            additional = cov[idx[n_isoforms:]].sum(0)
-            cov = cov[idx[:n_isoforms]]
-            cov[n_isoforms-1] += additional
+            idx = np.argpartition(-cov.sum(1), n_isoforms)[:n_isoforms]  # take the n_isoforms most expressed isoforms (random order)
+            cov = cov[idx]
+            cov[n_isoforms-1] += group_total - cov.sum(0)  # the coverage of the remaining isoforms
             idx[n_isoforms-1] = -1  # this isoform gets all other - I give it index
         elif cov.shape[0] < 2:
             return np.nan, np.nan, []
         else:
             idx = np.array(range(cov.shape[0]))
-        try:
-            _, pval, _, _ = chi2_contingency(cov)
-        except ValueError:
-            logger.error(f'chi2_contingency({cov})')
-            raise
+        # chi squared test of independence, as scipy.stats.chi2_contingency but without the result object overhead
+        from scipy.special import chdtrc
+        obs = cov[cov.sum(1) > 0][:, cov.sum(0) > 0]  # expected frequencies of empty rows/columns would be zero
+        row, col = obs.sum(1), obs.sum(0)
+        expected = np.outer(row, col) / col.sum()
+        dof = (obs.shape[0] - 1) * (obs.shape[1] - 1)
+        if dof == 0:
+            pval = 1.0
+        else:
+            if dof == 1:  # Yates' continuity correction, as applied by scipy for 2x2 tables
+                diff = expected - obs
+                obs = obs + np.sign(diff) * np.minimum(.5, np.abs(diff))
+            chi2 = ((obs - expected)**2 / expected).sum()
+            pval = chdtrc(dof, chi2)
         iso_frac = cov/cov.sum(0)
         deltaPI = iso_frac[..., 0]-iso_frac[..., 1]
+        # the two largest and the two smallest deltaPI
         order = np.argsort(deltaPI)
-        pos_idx = [order[-i] for i in range(1, 3) if deltaPI[order[-i]] > 0]
-        neg_idx = [order[i] for i in range(2) if deltaPI[order[i]] < 0]
+        top, bottom = order[:-3:-1], order[:2]
+        pos_idx = top[deltaPI[top] > 0]
+        neg_idx = bottom[deltaPI[bottom] < 0]
         deltaPI_pos = deltaPI[pos_idx].sum()
         deltaPI_neg = deltaPI[neg_idx].sum()
         if deltaPI_pos > -deltaPI_neg:
@@ -872,90 +956,86 @@ class Gene(Interval):
             return
         assert 0 <= search_range[0] <= .5 <= search_range[1] <= 1
         # get gene tss/pas profiles
-        tss = {}
-        pas = {}
         strand = 1 if self.strand == '+' else -1
-        for transcript in self.transcripts:
-            for sa in transcript['TSS']:
-                for pos, c in transcript['TSS'][sa].items():
-                    tss[pos] = tss.get(pos, 0)+c
-            for sa in transcript['PAS']:
-                for pos, c in transcript['PAS'][sa].items():
-                    pas[pos] = pas.get(pos, 0)+c
-
-        tss_pos = [min(tss), max(tss)]
-        if tss_pos[1]-tss_pos[0] < smooth_window:
-            tss_pos[0] -= (smooth_window + tss_pos[0]-tss_pos[1] - 1)
-        pas_pos = [min(pas), max(pas)]
-        if pas_pos[1]-pas_pos[0] < smooth_window:
-            pas_pos[0] -= (smooth_window + pas_pos[0]-pas_pos[1] - 1)
-        tss = [tss.get(pos, 0) for pos in range(tss_pos[0], tss_pos[1]+1)]
-        pas = [pas.get(pos, 0) for pos in range(pas_pos[0], pas_pos[1]+1)]
+        tss_pos, tss_cov = _site_counts(sa_tss for transcript in self.transcripts for sa_tss in transcript['TSS'].values())
+        pas_pos, pas_cov = _site_counts(sa_pas for transcript in self.transcripts for sa_pas in transcript['PAS'].values())
+        tss_range = [int(tss_pos.min()), int(tss_pos.max())]
+        if tss_range[1]-tss_range[0] < smooth_window:
+            tss_range[0] -= (smooth_window + tss_range[0]-tss_range[1] - 1)
+        pas_range = [int(pas_pos.min()), int(pas_pos.max())]
+        if pas_range[1]-pas_range[0] < smooth_window:
+            pas_range[0] -= (smooth_window + pas_range[0]-pas_range[1] - 1)
+        # dense profiles over [min, max]
+        tss = np.bincount(tss_pos-tss_range[0], weights=tss_cov, minlength=tss_range[1]-tss_range[0]+1)
+        pas = np.bincount(pas_pos-pas_range[0], weights=pas_cov, minlength=pas_range[1]-pas_range[0]+1)
         # smooth profiles and find maxima
-        tss_smooth = smooth(np.array(tss), smooth_window)
-        pas_smooth = smooth(np.array(pas), smooth_window)
+        from scipy.signal import find_peaks
+        tss_smooth = smooth(tss, smooth_window)
+        pas_smooth = smooth(pas, smooth_window)
         # at least half of smooth_window reads required to call a peak
         # minimal distance between peaks is > ~ smooth_window
         # rel_prominence=1 -> smaller peak must have twice the hight of valley to call two peaks
-        tss_peaks, _ = find_peaks(np.log2(tss_smooth+1), prominence=(rel_prominence, None))
-        tss_peak_pos = tss_peaks+tss_pos[0]-1
-        pas_peaks, _ = find_peaks(np.log2(pas_smooth+1), prominence=(rel_prominence, None))
-        pas_peak_pos = pas_peaks+pas_pos[0]-1
+        # log2(x+1) transform, in place on the smoothed profiles
+        for profile_smooth in (tss_smooth, pas_smooth):
+            profile_smooth += 1
+            np.log2(profile_smooth, out=profile_smooth)
+        tss_peaks, _ = find_peaks(tss_smooth, prominence=(rel_prominence, None))
+        tss_peak_pos = tss_peaks+tss_range[0]-1
+        pas_peaks, _ = find_peaks(pas_smooth, prominence=(rel_prominence, None))
+        pas_peak_pos = pas_peaks+pas_range[0]-1
 
         # find transcripts with common first/last splice site
-        first_junction = {}
-        last_junction = {}
-        for trid, transcript in enumerate(self.transcripts):
-            first_junction.setdefault(transcript['exons'][0][1], []).append(trid)
-            last_junction.setdefault(transcript['exons'][-1][0], []).append(trid)
+        n_tr = len(self.transcripts)
+        first_junction = _group_by(np.fromiter((tr['exons'][0][1] for tr in self.transcripts), dtype=np.int64, count=n_tr))
+        last_junction = _group_by(np.fromiter((tr['exons'][-1][0] for tr in self.transcripts), dtype=np.int64, count=n_tr))
         # first / last junction with respect to direction of transcription
         if self.strand == '-':
             first_junction, last_junction = last_junction, first_junction
         # for each site, find consistant "peaks" TSS/PAS
         # if none found use median of all read starts
-        for junction_pos, tr_ids in first_junction.items():
-            profile = {}
-            for trid in tr_ids:
-                for sa_tss in self.transcripts[trid]['TSS'].values():
-                    for pos, c in sa_tss.items():
-                        profile[pos] = profile.get(pos, 0) + c
-            quantiles = get_quantiles(sorted(profile.items()), [search_range[0], .5, search_range[1]])
+        for junction_pos, tr_ids in first_junction:
+            profile = _site_counts(sa_tss for trid in tr_ids for sa_tss in self.transcripts[trid]['TSS'].values())
+            quantiles = _site_quantiles(*profile, [search_range[0], .5, search_range[1]])
             # one/ several peaks within base range? -> quantify by next read_start
             # else use median
             ol_peaks = [p for p in tss_peak_pos if quantiles[0] < p <= quantiles[-1]]
             if not ol_peaks:
                 ol_peaks = [quantiles[1]]
+            # only peaks on the correct side of the junction are considered
+            peaks = np.array([p for p in ol_peaks if cmp_dist(junction_pos, p, min_dist=3) == strand], dtype=np.int64)
             for trid in tr_ids:
                 transcript = self.transcripts[trid]
                 transcript['TSS_unified'] = {}
                 for sa, sa_tss in transcript['TSS'].items():
+                    if not len(peaks):  # keep the positions
+                        transcript['TSS_unified'][sa] = dict(sa_tss)
+                        continue
                     tss_unified = {}
-                    for pos, c in sa_tss.items():  # for each read start position, find closest peak
-                        next_peak = min((p for p in ol_peaks if cmp_dist(junction_pos, p, min_dist=3) == strand),
-                                        default=pos, key=lambda x: abs(x-pos))
+                    next_peaks = _nearest_peak(peaks, np.fromiter(sa_tss, dtype=np.int64, count=len(sa_tss)))
+                    for next_peak, c in zip(next_peaks, sa_tss.values()):  # for each read start position, find closest peak
                         tss_unified[next_peak] = tss_unified.get(next_peak, 0)+c
                     transcript['TSS_unified'][sa] = tss_unified
         # same for PAS
-        for junction_pos, tr_ids in last_junction.items():
-            profile = {}
-            for trid in tr_ids:
-                for sa_pas in self.transcripts[trid]['PAS'].values():
-                    for pos, c in sa_pas.items():
-                        profile[pos] = profile.get(pos, 0)+c
-            quantiles = get_quantiles(sorted(profile.items()), [search_range[0], .5, search_range[1]])
+        for junction_pos, tr_ids in last_junction:
+            profile = _site_counts(sa_pas for trid in tr_ids for sa_pas in self.transcripts[trid]['PAS'].values())
+            quantiles = _site_quantiles(*profile, [search_range[0], .5, search_range[1]])
             # one/ several peaks within base range? -> quantify by next read_start
             # else use median
             ol_peaks = [p for p in pas_peak_pos if quantiles[0] < p <= quantiles[-1]]
             if not ol_peaks:
                 ol_peaks = [quantiles[1]]
+            # only peaks on the correct side of the junction are considered
+            peaks = np.array([p for p in ol_peaks if cmp_dist(p, junction_pos, min_dist=3) == strand], dtype=np.int64)
             for trid in tr_ids:
                 transcript = self.transcripts[trid]
                 transcript['PAS_unified'] = {}
                 for sa, sa_pas in transcript['PAS'].items():
+                    if not len(peaks):  # keep the positions
+                        transcript['PAS_unified'][sa] = dict(sa_pas)
+                        continue
                     pas_unified = {}
-                    for pos, c in sa_pas.items():
-                        next_peak = min((p for p in ol_peaks if cmp_dist(p, junction_pos, min_dist=3) == strand),
-                                        default=pos, key=lambda x: abs(x-pos))
+                    next_peaks = _nearest_peak(peaks, np.fromiter(sa_pas, dtype=np.int64, count=len(sa_pas)))
+                    for next_peak, c in zip(next_peaks, sa_pas.values()):
                         pas_unified[next_peak] = pas_unified.get(next_peak, 0)+c
                     transcript['PAS_unified'][sa] = pas_unified
         for transcript in self.transcripts:
@@ -995,27 +1075,116 @@ class Gene(Interval):
                     raise
 
 
-def _coding_len(exons, cds):
-    coding_len = [0, 0, 0]
-    state = 0
-    for e in exons:
-        if state < 2 and e[1] >= cds[state]:
-            coding_len[state] += cds[state] - e[0]
-            if state == 0 and cds[1] <= e[1]:  # special case: CDS start and end in same exon
-                coding_len[1] = cds[1] - cds[0]
-                coding_len[2] = e[1] - cds[1]
-                state += 2
-            else:
-                coding_len[state + 1] = e[1] - cds[state]
-                state += 1
-        else:
-            coding_len[state] += e[1] - e[0]
-    return coding_len
+def _revcomp(seq):
+    '''Returns the reverse complement of the DNA sequence.'''
+    return seq.encode('ascii').translate(_RC)[::-1].decode('ascii')
+
+
+def _fmt_attrs(items):
+    '''Formats (key, value) pairs as the attribute column of a gtf line.'''
+    return '; '.join(f'{k} "{v}"' for k, v in items)
+
+
+def _exon_arrays(exons):
+    '''Returns exon starts, exon ends and cumulative exon length as numpy arrays.
+
+    The cumulative length has one more entry than there are exons: cum_len[i] is the transcript position of the start of exon i,
+    and cum_len[-1] is the length of the transcript.'''
+    starts = np.fromiter((e[0] for e in exons), dtype=np.int64, count=len(exons))
+    ends = np.fromiter((e[1] for e in exons), dtype=np.int64, count=len(exons))
+    cum_len = np.zeros(len(exons)+1, dtype=np.int64)
+    np.cumsum(ends-starts, out=cum_len[1:])
+    return starts, ends, cum_len
+
+
+def _junction_arrays(starts, ends, reverse_strand):
+    '''Returns the positions of the donor and acceptor sites of the introns as numpy arrays, in the direction of transcription.'''
+    if reverse_strand:
+        return starts[1:][::-1], ends[:-1][::-1]
+    return ends[:-1], starts[1:]
+
 
+def _fetch_padded(genome_fh, chrom, start, end):
+    '''Fetches the genomic sequence, padded with "N" where the region exceeds the chromosome.'''
+    chr_len = genome_fh.get_reference_length(chrom)
+    seq = genome_fh.fetch(chrom, max(0, start), min(chr_len, end))
+    return 'N' * max(0, -start) + seq + 'N' * max(0, end - chr_len)
 
+
+def _exons_key(transcript_exons):
+    '''Packs the exons of several transcripts into bytes, identifying the content for the segment graph.'''
+    flat = [len(exons) for exons in transcript_exons]  # exon numbers first, to separate the transcripts
+    for exons in transcript_exons:
+        for exon in exons:
+            flat.extend(exon)
+    return np.array(flat, dtype=np.int64).tobytes()
+
+
+@lru_cache(maxsize=64)
+def _group_indicator(groups, n_samples):
+    '''Returns a samples x groups matrix, such that coverage.T @ indicator sums the coverage of the samples in each group.'''
+    indicator = np.zeros((n_samples, len(groups)))
+    for k, grp in enumerate(groups):
+        idx = np.asarray(grp)
+        if idx.dtype == bool and len(idx) == n_samples:  # boolean mask
+            idx = np.flatnonzero(idx)
+        elif idx.size and idx.dtype.kind not in 'iu':
+            # sample names (also numeric strings like '1') must be looked up by the caller
+            raise IndexError(f'group {grp} is not given as sample indices')
+        np.add.at(indicator[:, k], idx.astype(np.intp), 1)
+    indicator.flags.writeable = False  # shared between calls
+    return indicator
+
+
+def _group_by(keys):
+    '''Groups the indices of equal keys. Returns a list of (key, indices) tuples, sorted by key.'''
+    order = np.argsort(keys, kind='stable')
+    unique_keys, group_start = np.unique(keys[order], return_index=True)
+    return list(zip(unique_keys.tolist(), (grp.tolist() for grp in np.split(order, group_start[1:]))))
+
+
+def _nearest_peak(peaks, pos):
+    '''For each position, returns the closest of the sorted peaks (the peak with the smaller coordinate in case of a tie).'''
+    idx = np.searchsorted(peaks, pos)
+    left = peaks[np.maximum(idx - 1, 0)]
+    right = peaks[np.minimum(idx, len(peaks) - 1)]
+    return np.where(np.abs(left - pos) <= np.abs(right - pos), left, right).tolist()
+
+
+def _site_counts(site_dicts):
+    '''Concatenates {position: count} dicts (e.g. the TSS or PAS per sample) into a position and a count array.'''
+    pos, cov = [], []
+    for sites in site_dicts:
+        pos.extend(sites)
+        cov.extend(sites.values())
+    return np.array(pos, dtype=np.int64), np.array(cov, dtype=np.float64)
+
+
+def _site_quantiles(pos, cov, percentile):
+    '''Same as get_quantiles for position and count arrays (positions may occur repeatedly).'''
+    order = np.argsort(pos, kind='stable')
+    cum_cov = np.cumsum(cov[order])
+    if not len(cum_cov):
+        raise ValueError(f'cannot find {percentile[0]} percentile of empty profile')
+    idx = np.searchsorted(cum_cov, cum_cov[-1] * np.asarray(percentile), side='left')
+    return pos[order[idx]].tolist()
+
+
+def _coding_len(exon_arrays, cds):
+    # exon_arrays as returned by _exon_arrays
+    starts, ends, cum_len = exon_arrays
+    idx = np.searchsorted(ends, cds)  # first exon ending at or after the CDS start/end
+    cds_start, cds_end = (cum_len[idx] + cds - starts[idx]).tolist()  # position in transcript
+    return [cds_start, cds_end - cds_start, int(cum_len[-1]) - cds_end]
+
+
+@lru_cache(maxsize=4096)
 def repeat_len(seq1, seq2, wobble, max_mm):
     ''' Calcluate direct repeat length between seq1 and seq2
     '''
+    kernel = _repeat_len_kernel()
+    if kernel is not None:
+        return int(kernel(np.frombuffer(seq1.encode('ascii'), dtype=np.uint8), np.frombuffer(seq2.encode('ascii'), dtype=np.uint8), wobble, max_mm))
     score = [0]*(2*wobble+1)
     delta = int(len(seq1)/2-wobble)
     for w in range(2*wobble+1):  # wobble
@@ -1044,3 +1213,50 @@ def find_runlength(align, max_mm):
     for i in range(mm+1, max_mm+1):
         score[i] = score[i-1]
     return score
+
+
+@lru_cache(maxsize=None)
+def _repeat_len_kernel():
+    '''Compiles repeat_len for uint8 arrays with numba. Returns None if numba is not installed.'''
+    try:
+        from numba import njit  # compiling takes a few seconds, hence the lazy import here
+    except ImportError:
+        return None
+
+    @njit(cache=True)
+    def find_runlength_kernel(s1, s2, start, stop, step, score):
+        # same as find_runlength, but compares s1[i] and s2[i] for i in range(start, stop, step) on the fly
+        score[:] = 0
+        mm = 0
+        for i in range(start, stop, step):
+            if s1[i] != s2[i]:
+                mm += 1
+                if mm > len(score) - 1:
+                    return
+                score[mm] = score[mm-1]
+            else:
+                score[mm] += 1
+        for i in range(mm+1, len(score)):
+            score[i] = score[i-1]
+
+    @njit(cache=True)
+    def repeat_len_kernel(seq1, seq2, wobble, max_mm):
+        best = 0
+        score_left = np.zeros(max_mm+1, dtype=np.int32)
+        score_right = np.zeros(max_mm+1, dtype=np.int32)
+        s2 = seq2[wobble:len(seq2)-wobble]
+        for w in range(2*wobble+1):  # wobble
+            s1 = seq1[w:len(seq1)-(2*wobble-w)]
+            n = min(len(s1), len(s2))
+            # split point of the alignment, with python slice semantics for align[:delta] and align[delta:]
+            delta = int(len(seq1)/2-wobble)
+            if delta < 0:
+                delta += n
+            delta = min(max(delta, 0), n)
+            find_runlength_kernel(s1, s2, delta-1, -1, -1, score_left)
+            find_runlength_kernel(s1, s2, delta, n, 1, score_right)
+            for fmm in range(max_mm+1):
+                best = max(best, score_left[fmm]+score_right[max_mm-fmm])
+        return best
+
+    return repeat_len_kernel
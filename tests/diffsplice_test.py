@@ -10,3 +10,17 @@ def test_diffsplice():
     assert (best.start, best.end) == (408496, 414779), 'Genomic coordinates do not match expectations.'
     assert best.splice_type == 'ME', 'Splice type does not match expectations.'
     assert best.padj < .001, 'Event should be more significant.'
+
+
+def test_numeric_sample_names():
+    isoseq = Transcriptome.load('tests/data/example_1_isotools.pkl')
+    by_index = [g.die_test([[0], [1]], min_cov=5) for g in isoseq]
+    # sample names that look like indices, in reverse order: '1' is the first sample, '0' the second
+    sample_table = isoseq.sample_table.copy()
+    sample_table['name'] = ['1', '0']
+    isoseq.infos['sample_table'] = sample_table
+    by_name = [g.die_test({'1': ['1'], '0': ['0']}, min_cov=5) for g in isoseq]
+    assert repr(by_name) == repr(by_index), 'numeric sample names must be looked up, not used as indices'
+    by_index = [g.coordination_test(samples=[0], min_total=5) for g in isoseq]
+    by_name = [g.coordination_test(samples=['1'], min_total=5) for g in isoseq]
+    assert repr(by_name) == repr(by_index), 'numeric sample names must be looked up, not used as indices'
@@ -0,0 +1,17 @@
+import pytest
+import random
+from isotools import gene
+
+
+def test_repeat_len_kernel(monkeypatch):
+    if gene._repeat_len_kernel() is None:
+        pytest.skip('numba not installed')
+    random.seed(42)
+    pairs = []
+    for _ in range(200):
+        seq1 = ''.join(random.choices('ACGT', k=30))
+        seq2 = seq1[:random.randint(0, 30)] + ''.join(random.choices('ACGT', k=30))
+        pairs.append((seq1, seq2[:30], random.randint(0, 2), random.randint(0, 2)))
+    compiled = [gene.repeat_len.__wrapped__(*p) for p in pairs]
+    monkeypatch.setattr(gene, '_repeat_len_kernel', lambda: None)  # fall back to the python implementation
+    assert compiled == [gene.repeat_len.__wrapped__(*p) for p in pairs]
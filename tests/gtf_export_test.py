@@ -0,0 +1,40 @@
+import re
+from isotools import Transcriptome
+
+
+def _attributes(line):
+    return dict(re.findall(r'(\w+) "([^"]*)"', line.split('\t')[8]))
+
+
+def test_ref_transcripts_gtf():
+    isoseq = Transcriptome.load('tests/data/example_1_isotools.pkl')
+    n_cds = {'+': 0, '-': 0}
+    for g in isoseq:
+        if not g.is_annotated:
+            continue
+        lines = g._to_gtf(trids=[], ref_trids=True)
+        assert lines[0].split('\t')[2] == 'gene'
+        fields = [line.split('\t') for line in lines[1:]]
+        assert [f[2] for f in fields].count('transcript') == g.n_ref_transcripts, 'expected one line per reference transcript'
+        k = 1
+        for i, tr in enumerate(g.ref_transcripts):
+            # the reference transcript_id replaces the generated one
+            transcript_id = tr.get('transcript_id', f'{g.id}_ref{i}')
+            chrom, source, feature, start, end, _, strand, _, _ = fields[k-1]
+            attr = _attributes(lines[k])
+            assert (chrom, source, feature, strand) == (g.chrom, 'annotation', 'transcript', g.strand)
+            assert (int(start), int(end)) == (tr['exons'][0][0] + 1, tr['exons'][-1][1])
+            assert attr['gene_id'] == g.id and attr['transcript_id'] == transcript_id
+            if 'CDS' in tr:
+                cds = (int(attr['CDS_start']), int(attr['CDS_end']))
+                assert cds == (tr['CDS'] if g.strand == '+' else tr['CDS'][::-1]), 'CDS start/end should follow the direction of transcription'
+                n_cds[g.strand] += 1
+            for enr, exon in enumerate(tr['exons']):
+                k += 1
+                attr = _attributes(lines[k])
+                assert fields[k-1][2] == 'exon'
+                assert (int(fields[k-1][3]), int(fields[k-1][4])) == (exon[0] + 1, exon[1])
+                assert attr['transcript_id'] == transcript_id and attr['exon_id'] == f'{g.id}_ref{i}_{enr}'
+            k += 1
+        assert k == len(lines)
+    assert n_cds['+'] and n_cds['-'], 'expected coding reference transcripts on both strands'
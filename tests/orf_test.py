@@ -0,0 +1,32 @@
+from pysam import FastaFile
+from isotools import Transcriptome
+from isotools._utils import find_orfs, kozak_score, DEFAULT_KOZAK_PWM
+
+
+def test_min_kozak():
+    isoseq = Transcriptome.load('tests/data/example_1_isotools.pkl')
+    min_kozak, minlen, max_5utr_len = 0, 100, 1000
+    n_tested = n_skipped = 0
+    with FastaFile('tests/data/example.fa') as genome_fh:
+        for g in isoseq:
+            for tr in g.transcripts:
+                tr.pop('ORF', None)
+            g.add_orfs(genome_fh, minlen=minlen, min_kozak=min_kozak, max_5utr_len=max_5utr_len)
+            ref_cds = g._get_ref_cds_pos()
+            for trid, seq in g.get_sequence(genome_fh).items():
+                tr = g.transcripts[trid]
+                if 'ORF' not in tr or tr['ORF'][2]['ref_ids']:
+                    continue  # min_kozak does not apply to annotated initiation sites
+                orf_dict = tr['ORF'][2]
+                start = orf_dict["5'UTR"]
+                assert orf_dict['kozak'] == kozak_score(seq, start, DEFAULT_KOZAK_PWM), 'kozak score does not belong to the reported ORF'
+                assert orf_dict['kozak'] > min_kozak
+                # the reported ORF is the first valid ORF passing the kozak threshold
+                valid_orfs = [orf for orf in find_orfs(seq, ref_cds=ref_cds[trid])
+                              if orf[1] is not None and orf[1]-orf[0] > minlen and orf[0] <= max_5utr_len]
+                selected = next(orf for orf in valid_orfs if kozak_score(seq, orf[0], DEFAULT_KOZAK_PWM) > min_kozak)
+                assert (start, start + orf_dict['CDS']) == tuple(selected[:2])
+                n_tested += 1
+                n_skipped += selected is not valid_orfs[0]
+    assert n_skipped > 0, 'expected transcripts where the first ORF is rejected by the kozak threshold'
+    assert n_tested > n_skipped
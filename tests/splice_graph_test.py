@@ -34,3 +34,15 @@ def test_import_exonic_overlap():
         c2 = _get_overlap(tr['exons'], g.ref_transcripts)
         assert c1 == c2, 'isotools._transcriptome_io._get_overlap and Segment_Graph.get_overlap yield different results'
     assert True
+
+
+def test_gene_find_splice_sites(example_gene):
+    expected = {'FSM': [True, True, True],
+                'novel junction': [True, True, False],
+                'novel combination': [True, True],  # (40, 75) is an intron of reference 2
+                'exon skipping': [False, True],
+                'mono-exon': []}
+    for tr in example_gene.transcripts:
+        if tr['transcript_name'] in expected:
+            contained = example_gene._find_splice_sites(tr['exons'], example_gene.ref_transcripts)
+            assert list(contained) == expected[tr['transcript_name']], f'unexpected splice sites for {tr["transcript_name"]}'